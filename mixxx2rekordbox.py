@@ -1,43 +1,79 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import sqlite3
 import sys
 import os
+import stat
 import configparser
-from pathlib import Path
+import functools
+import re
+import shutil
+from collections import defaultdict
+from dataclasses import dataclass, field
 from urllib.parse import quote
-from xml.etree import ElementTree as ET
-from xml.dom import minidom
+try:
+    # libxml2-backed element construction and serialization, if installed
+    from lxml import etree as ET
+    # write_element needs indent(), which lxml only has from 4.5 on
+    if not hasattr(ET, "indent"):
+        raise ImportError("lxml is too old")
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+def normalize_path(path):
+    """Expands ~ and makes a path absolute; used as the argparse type for path options."""
+    # Keep empty values empty so main() can still report a missing path
+    if not path:
+        return path
+    return os.path.abspath(os.path.expanduser(path))
 
 def get_db_connection(db_file):
-    """Establishes a read-only connection to the SQLite database."""
+    """Establishes a read-only connection to the SQLite database at an already normalized path."""
     try:
-        normalized_path = os.path.abspath(os.path.expanduser(db_file))
-        conn = sqlite3.connect(f"file:{normalized_path}?mode=ro", uri=True)
+        # Autocommit: nothing is written, so skip implicit transaction handling
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True,
+                               cached_statements=256, isolation_level=None)
         conn.row_factory = sqlite3.Row
+        # Read-only workload: memory-map the file and keep a 64 MiB page cache
+        conn.executescript("PRAGMA mmap_size=268435456; PRAGMA cache_size=-65536; "
+                           "PRAGMA temp_store=MEMORY; PRAGMA query_only=1;")
         return conn
     except sqlite3.Error as e:
         print(f"Error connecting to database: {e}", file=sys.stderr)
         sys.exit(1)
 
+CONFIG_FILES = (os.path.join(os.getcwd(), ".mixxx2rekordbox"),
+                os.path.join(os.path.expanduser("~"), ".mixxx2rekordbox"))
+
+@functools.lru_cache(maxsize=4)
+def parse_config_file(path, mtime_ns):
+    """Parses the [default] section of a config file; mtime_ns only keys the cache."""
+    config = configparser.ConfigParser()
+    with open(path, 'r', encoding='utf-8') as fh:
+        config.read_file(fh)
+    # ~ in db_path/output_path is expanded by argparse (see normalize_path)
+    return dict(config['default']) if 'default' in config else {}
+
 def load_config():
     """Loads configuration from .mixxx2rekordbox in current or home directory."""
-    config = configparser.ConfigParser()
-    files_to_check = [Path.cwd() / ".mixxx2rekordbox", Path.home() / ".mixxx2rekordbox"]
-    
-    conf_dict = {}
-    for config_path in files_to_check:
-        if config_path.exists():
-            config.read(config_path)
-            if 'default' in config:
-                conf_dict = dict(config['default'])
-                # Expand ~ paths in config
-                for key in ['db_path', 'output_path']:
-                    if key in conf_dict:
-                        conf_dict[key] = os.path.expanduser(conf_dict[key])
-            break
-    return conf_dict
+    for config_path in CONFIG_FILES:
+        # A single stat both checks for the file and provides the cache key
+        try:
+            st = os.stat(config_path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            conf_dict = parse_config_file(config_path, st.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            # e.g. permission denied: ignore this file like ConfigParser.read would
+            print(f"Warning: skipping config file {config_path}: {e}", file=sys.stderr)
+            continue
+        # Copy so callers can't mutate the cached result
+        return dict(conf_dict)
+    return {}
 
 def get_collections(conn, include_names=None, exclude_names=None, mode='crates'):
     """Fetches crates or playlists from the database."""
@@ -50,12 +86,23 @@ def get_collections(conn, include_names=None, exclude_names=None, mode='crates')
     }
     main_table, link_table, fk_id = table_map[mode]
 
+    # Filter by name in SQL so only the selected rows are fetched
+    conditions, params = [], []
+    if mode == 'playlists':
+        conditions.append("hidden = 0")
+    if include_names is not None:
+        conditions.append("name IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(include_names)))
+    elif exclude_names:
+        conditions.append("name NOT IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(exclude_names)))
+
     try:
         query = f"SELECT id, name FROM {main_table}"
-        if mode == 'playlists':
-            query += " WHERE hidden = 0"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
         
-        cursor.execute(query)
+        cursor.execute(query, params)
         for row in cursor.fetchall():
             all_db_items[row['name']] = row['id']
     except sqlite3.Error as e:
@@ -63,9 +110,8 @@ def get_collections(conn, include_names=None, exclude_names=None, mode='crates')
         return {}, set()
 
     if include_names is not None:
+        # Keep the order the names were requested in
         final_names = [n for n in include_names if n in all_db_items]
-    elif exclude_names:
-        final_names = [name for name in all_db_items if name not in exclude_names]
     else:
         final_names = list(all_db_items.keys())
     
@@ -73,108 +119,203 @@ def get_collections(conn, include_names=None, exclude_names=None, mode='crates')
         return {}, set()
 
     collection_data = {name: {'id': all_db_items[name], 'tracks': []} for name in final_names}
-    item_ids = [c['id'] for c in collection_data.values()]
-    placeholders = ', '.join('?' for _ in item_ids)
+    id_to_name = {all_db_items[name]: name for name in final_names}
+    item_ids = list(id_to_name)
     
-    tracks_query = f"SELECT {fk_id}, track_id FROM {link_table} WHERE {fk_id} IN ({placeholders})"
+    tracks_query = f"SELECT {fk_id}, track_id FROM {link_table} WHERE {fk_id} IN (SELECT value FROM json_each(?))"
     if mode == 'playlists':
         tracks_query += " ORDER BY position ASC"
     
     all_track_ids = set()
     try:
-        cursor.execute(tracks_query, item_ids)
-        id_to_name = {v['id']: k for k, v in collection_data.items()}
-        for row in cursor.fetchall():
-            name = id_to_name.get(row[fk_id])
-            if name:
-                collection_data[name]['tracks'].append(row['track_id'])
-                all_track_ids.add(row['track_id'])
+        cursor.execute(tracks_query, (json.dumps(item_ids),))
+        # The IN filter guarantees every row's id is in id_to_name
+        for row in cursor:
+            collection_data[id_to_name[row[fk_id]]]['tracks'].append(row['track_id'])
+            all_track_ids.add(row['track_id'])
     except sqlite3.Error as e:
         print(f"Error fetching {mode} tracks: {e}", file=sys.stderr)
 
     return collection_data, all_track_ids
 
+# slots=True needs Python 3.10+
+@dataclass(slots=True)
+class Track:
+    """One row of track metadata; field order matches the SELECT in get_track_details.
+
+    Every column but the id may be NULL in the Mixxx database.
+    """
+    id: int
+    artist: str | None
+    title: str | None
+    album: str | None
+    year: str | None
+    genre: str | None
+    grouping: str | None
+    tracknumber: str | None
+    comment: str | None
+    samplerate: int | None
+    bitrate: int | None
+    bpm: float | None
+    datetime_added: str | None
+    duration: float | None
+    location: str | None
+    filesize: int | None
+    cues: list[int] = field(default_factory=list)
+
 def get_track_details(conn, track_ids):
-    """Fetches metadata from 'library' and 'track_locations'."""
+    """Fetches metadata from 'library' and 'track_locations' along with memory cues."""
     if not track_ids: return {}
     track_details = {}
-    placeholders = ', '.join('?' for _ in track_ids)
+    track_ids_json = json.dumps(list(track_ids))
 
-    query = f"""
+    query = """
         SELECT l.id, l.artist, l.title, l.album, l.year, l.genre, l.grouping,
                l.tracknumber, l.comment, l.samplerate, l.bitrate, l.bpm,
                l.datetime_added, l.duration, tl.location, tl.filesize
         FROM library l 
         JOIN track_locations tl ON l.location = tl.id
-        WHERE l.id IN ({placeholders})
+        WHERE l.id IN (SELECT value FROM json_each(?))
+        ORDER BY l.id
     """
-    cues_query = f"SELECT track_id, position FROM cues WHERE track_id IN ({placeholders}) AND type = 1"
+    # Kept separate from the query above: joining cues there makes SQLite scan
+    # the whole (unindexed) cues table once per track instead of once in total
+    cues_query = "SELECT track_id, position FROM cues WHERE type = 1 AND track_id IN (SELECT value FROM json_each(?))"
 
     cursor = conn.cursor()
+    # Plain tuples are unpacked positionally into Track
+    cursor.row_factory = None
     try:
-        cursor.execute(query, list(track_ids))
-        for row in cursor.fetchall():
-            track_details[row['id']] = dict(row)
-            track_details[row['id']]['cues'] = []
+        cursor.execute(query, (track_ids_json,))
+        # Iterate the cursor so rows are consumed as they are stepped, not all at once
+        for row in cursor:
+            track_details[row[0]] = Track(*row)
 
-        cursor.execute(cues_query, list(track_ids))
-        for row in cursor.fetchall():
-            tid = row['track_id']
-            if tid in track_details:
-                track_details[tid]['cues'].append(row['position'])
+        cursor.execute(cues_query, (track_ids_json,))
+        for tid, position in cursor:
+            track = track_details.get(tid)
+            if track is not None and position is not None:
+                track.cues.append(position)
     except sqlite3.Error as e:
         print(f"Error fetching track metadata: {e}", file=sys.stderr)
         
     return track_details
 
-def build_xml(track_details, collections, is_playlist_mode=False, sort_order=None):
-    """Builds the Rekordbox XML structure."""
-    dj_playlists = ET.Element("DJ_PLAYLISTS", Version="1.0.0")
-    ET.SubElement(dj_playlists, "PRODUCT", Name="rekordbox", Version="6.8.6", Company="AlphaTheta")
+INDENT = "  "
+TRACK_KIND = "MP3 File"
+DEFAULT_SAMPLERATE = 44100.0
+# (XML attribute, Track field, is text) entries written only when the field is set;
+# Mixxx metadata is often sparse, so empty/zero values are left out.
+# Only text fields can contain characters that need xml_text().
+OPTIONAL_TRACK_ATTRS = (
+    ("Artist", "artist", True), ("Album", "album", True), ("Grouping", "grouping", True),
+    ("Genre", "genre", True), ("Year", "year", True), ("TrackNumber", "tracknumber", True),
+    ("Comments", "comment", True), ("Size", "filesize", False),
+    ("BitRate", "bitrate", False), ("SampleRate", "samplerate", False),
+)
+
+# Characters outside the XML 1.0 Char production (control characters, U+FFFE/U+FFFF);
+# lxml refuses them and ElementTree writes them out as an unparseable document
+INVALID_XML_CHARS = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+def xml_text(value):
+    """Drops characters that cannot appear in an XML document from a metadata string."""
+    return INVALID_XML_CHARS.sub("", value)
+
+def write_element(out, elem, level):
+    """Serializes a single element (and its children) at the given nesting level."""
+    ET.indent(elem, space=INDENT, level=level)
+    out.write(f"{INDENT * level}{ET.tostring(elem, encoding='unicode')}\n")
+
+@functools.lru_cache(maxsize=None)
+def quote_dir(path):
+    """URL-quotes a directory path; tracks in a library share a small set of directories."""
+    return quote(path)
+
+def location_url(location):
+    """Builds the file:// URL for a track, quoting its directory only once per export."""
+    # '/' is safe for quote(), so quoting the two halves separately gives the same result
+    head, sep, tail = location.rpartition('/')
+    return f"file://localhost{quote_dir(head)}{sep}{quote(tail)}"
+
+def build_xml(out, track_details, collections, is_playlist_mode=False, sort_order=None):
+    """Streams the Rekordbox XML structure to `out`, one element at a time."""
+    out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+    out.write('<DJ_PLAYLISTS Version="1.0.0">\n')
+    write_element(out, ET.Element("PRODUCT", Name="rekordbox", Version="6.8.6", Company="AlphaTheta"), 1)
     
-    collection_node = ET.SubElement(dj_playlists, "COLLECTION", Entries=str(len(track_details)))
-    for track_id, data in sorted(track_details.items()):
-        location_url = f"file://localhost{quote(data.get('location', ''))}"
+    out.write(f'{INDENT}<COLLECTION Entries="{len(track_details)}">\n')
+    # track_details is already in id order (ORDER BY l.id)
+    for track_id, data in track_details.items():
         track_attribs = {
-            "TrackID": str(track_id), "Name": data.get('title') or "",
-            "Artist": data.get('artist') or "", "Album": data.get('album') or "",
-            "Grouping": data.get('grouping') or "", "Genre": data.get('genre') or "",
-            "Year": str(data.get('year') or ""), "TrackNumber": str(data.get('tracknumber') or ""),
-            "Comments": data.get('comment') or "", "Location": location_url,
-            "Kind": "MP3 File", "Size": str(data.get('filesize') or "0"),
-            "TotalTime": str(round(data.get('duration') or 0.0)),
-            "AverageBpm": f"{data.get('bpm', 0.0):.2f}",
-            "BitRate": str(data.get('bitrate') or "0"), "SampleRate": str(data.get('samplerate') or "0")
+            "TrackID": str(track_id), "Name": xml_text(data.title or ""),
+            "Location": location_url(data.location), "Kind": TRACK_KIND,
+            "TotalTime": str(round(data.duration or 0.0)),
+            "AverageBpm": f"{data.bpm or 0.0:.2f}",
         }
-        track_node = ET.SubElement(collection_node, "TRACK", **track_attribs)
+        track_attribs.update((key, xml_text(str(value)) if is_text else str(value))
+                             for key, attr, is_text in OPTIONAL_TRACK_ATTRS
+                             if (value := getattr(data, attr)))
+        # Pass attribute dicts positionally to skip ElementTree's kwargs merge
+        track_node = ET.Element("TRACK", track_attribs)
         
-        samplerate = float(data.get('samplerate', 44100.0) or 44100.0)
-        for cue_pos in sorted(data.get('cues', [])):
+        samplerate = float(data.samplerate or DEFAULT_SAMPLERATE)
+        for cue_pos in sorted(data.cues):
             pos = (cue_pos / 2.0) / samplerate
-            ET.SubElement(track_node, "POSITION_MARK", Name="", Type="0", Start=f"{pos:.3f}", Num="-1")
+            ET.SubElement(track_node, "POSITION_MARK", {"Name": "", "Type": "0", "Start": f"{pos:.3f}", "Num": "-1"})
+        write_element(out, track_node, 2)
+    out.write(f"{INDENT}</COLLECTION>\n")
 
-    playlists_root = ET.SubElement(dj_playlists, "PLAYLISTS")
-    root_node = ET.SubElement(playlists_root, "NODE", Type="0", Name="ROOT", Count=str(len(collections)))
+    out.write(f"{INDENT}<PLAYLISTS>\n")
+    out.write(f'{INDENT * 2}<NODE Type="0" Name="ROOT" Count="{len(collections)}">\n')
     
+    # Only sort if we are in Crate mode and sort order is specified
+    sort_by_bpm = not is_playlist_mode and sort_order
+    if sort_by_bpm:
+        # Built once for all crates; tracks missing from the library sort as 0 BPM
+        bpm_of = defaultdict(float, {tid: data.bpm or 0.0 for tid, data in track_details.items()})
+
     for name, data in sorted(collections.items()):
-        playlist_node = ET.SubElement(root_node, "NODE", Name=name, Type="1", KeyType="0", Entries=str(len(data['tracks'])))
+        playlist_node = ET.Element("NODE", Name=xml_text(name), Type="1", KeyType="0", Entries=str(len(data['tracks'])))
         track_list = data['tracks']
         
-        # Only sort if we are in Crate mode and sort order is specified
-        if not is_playlist_mode and sort_order:
-            track_list = sorted(track_list, key=lambda tid: track_details.get(tid, {}).get('bpm', 0.0) or 0.0, reverse=(sort_order == 'desc'))
+        if sort_by_bpm:
+            track_list = sorted(track_list, key=bpm_of.__getitem__, reverse=(sort_order == 'desc'))
             
         for tid in track_list:
-            ET.SubElement(playlist_node, "TRACK", Key=str(tid))
+            ET.SubElement(playlist_node, "TRACK", {"Key": str(tid)})
+        write_element(out, playlist_node, 3)
             
-    return dj_playlists
+    out.write(f"{INDENT * 2}</NODE>\n")
+    out.write(f"{INDENT}</PLAYLISTS>\n")
+    out.write("</DJ_PLAYLISTS>\n")
+
+def write_export(output_path, track_details, collections, is_playlist_mode=False, sort_order=None):
+    """Streams the XML to a temp file next to `output_path` and only replaces it once complete."""
+    # Write through symlinks: replace the file they point to, not the link itself
+    target = os.path.realpath(output_path)
+    target_dir, target_name = os.path.split(target)
+    tmp_path = os.path.join(target_dir, f".{target_name}.{os.urandom(4).hex()}.tmp")
+    # O_EXCL never reuses an existing file; 0o666 is reduced by the umask, as with open(..., "w")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            build_xml(f, track_details, collections, is_playlist_mode, sort_order)
+        # Keep the permissions of an existing export
+        if os.path.exists(target):
+            shutil.copymode(target, tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        # Leave any previous export untouched
+        os.unlink(tmp_path)
+        raise
 
 def main():
     config = load_config()
     parser = argparse.ArgumentParser(description="Convert Mixxx data to rekordbox.xml")
     
-    parser.add_argument("mixxx_db_path", nargs='?', default=config.get('db_path'), help="Path to mixxx.sqlite")
-    parser.add_argument("-o", "--output", default=config.get('output_path', 'rekordbox.xml'), help="Output XML path")
+    parser.add_argument("mixxx_db_path", nargs='?', default=config.get('db_path'), type=normalize_path, help="Path to mixxx.sqlite")
+    parser.add_argument("-o", "--output", default=config.get('output_path', 'rekordbox.xml'), type=normalize_path, help="Output XML path")
     
     parser.add_argument("-p", "--playlists", nargs="*", help="Export playlists. If no names given, uses config.")
     parser.add_argument("-e", "--exclude-crates", nargs="+", 
@@ -190,8 +331,7 @@ def main():
         print("Error: Database path required.", file=sys.stderr)
         sys.exit(1)
 
-    db_path = os.path.expanduser(args.mixxx_db_path)
-    conn = get_db_connection(db_path)
+    conn = get_db_connection(args.mixxx_db_path)
 
     if args.list_crates:
         items, _ = get_collections(conn, mode='crates')
@@ -226,12 +366,8 @@ def main():
     track_details = get_track_details(conn, track_ids)
     conn.close()
     
-    xml_tree = build_xml(track_details, collections, is_playlist_mode, args.sort_by_bpm)
-    pretty_xml = minidom.parseString(ET.tostring(xml_tree, 'utf-8')).toprettyxml(indent="  ")
-
-    output_path = os.path.expanduser(args.output)
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(pretty_xml)
+    output_path = args.output
+    write_export(output_path, track_details, collections, is_playlist_mode, args.sort_by_bpm)
     print(f"Exported to {output_path}")
 
 if __name__ == "__main__":